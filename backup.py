@@ -1,106 +1,249 @@
 import platform
+import os
+import functools
 from pathlib import Path
 import yaml
+try:
+    from yaml import CSafeLoader as SafeLoader  # Requires PyYAML built with libyaml
+except ImportError:
+    from yaml import SafeLoader
 import shutil
 import subprocess
-import json
-
-from functional import seq
+import ast
+import re
+import pickle
+from concurrent.futures import ThreadPoolExecutor
 
 import uploadutils
 
-def copy_files_specified_by_yaml(yaml_file, destination_folder):
-    with open(yaml_file) as f:
-        data = yaml.load(f, Loader=yaml.FullLoader)
+def load_yaml_cached(yaml_file):
+    """Loads a YAML file, caching the parsed result in "<yaml_file>.cache" keyed on the modification time of the YAML file."""
+    yaml_file = Path(yaml_file)
+    cache_file = yaml_file.with_name(yaml_file.name + '.cache')
+    mtime = yaml_file.stat().st_mtime_ns
+
+    if cache_file.exists():
+        try:
+            with open(cache_file, 'rb') as f:
+                cached_mtime, data = pickle.load(f)
+            if cached_mtime == mtime:
+                return data
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError, TypeError):
+            pass  # Unreadable or corrupted cache. Re-parse below and overwrite it.
 
-    files = seq(data['files']).map(lambda x: Path(x)).map(lambda x: x.expanduser()).list()
-    folders = seq(data['folders']).map(lambda x: Path(x)).map(lambda x: x.expanduser()).list()
+    with open(yaml_file) as f:
+        data = yaml.load(f, Loader=SafeLoader)
+
+    # The cache is only an optimization, so failing to write it (e.g. read-only folder or full disk) is not an error.
+    # Written to a temporary file first so that an interrupted write never leaves a truncated cache.
+    temporary_cache_file = cache_file.with_name(f'{cache_file.name}.{os.getpid()}.tmp')
+    try:
+        with open(temporary_cache_file, 'wb') as f:
+            pickle.dump((mtime, data), f)
+        os.replace(temporary_cache_file, cache_file)
+    except OSError as e:
+        print(f'Could not write {cache_file}: {e}')
+        temporary_cache_file.unlink(missing_ok=True)
+
+    return data
+
+def copy_file(src, dst):
+    """Same as shutil.copy2, but copies the data with os.copy_file_range on Linux so that it never leaves the kernel."""
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+
+    if hasattr(os, 'copy_file_range'):
+        try:
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), 2 ** 30)
+                # Some filesystems (e.g. procfs, some FUSE and network filesystems) return 0 instead of raising.
+                # Only trust it as the end of the file if the file is really empty.
+                supported = copied > 0 or os.fstat(fsrc.fileno()).st_size == 0
+                while copied:
+                    copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), 2 ** 30)
+        except OSError:
+            # e.g. older kernels or filesystems that do not support copy_file_range
+            supported = False
+        if not supported:
+            shutil.copyfile(src, dst)
+    else:
+        # shutil already uses fcopyfile on macOS
+        shutil.copyfile(src, dst)
 
-    # Copy files
-    for file in files:
-        shutil.copy(file, destination_folder)
+    shutil.copystat(src, dst)
+    return dst
 
-    # Copy folders
-    for folder in folders:
-        shutil.copytree(folder, destination_folder / folder.name)
+def copy_files_specified_by_yaml(yaml_file, destination_folder):
+    data = load_yaml_cached(yaml_file)
 
-def generate_brew_list(destination_folder):
-    # Capture output of cat ~/.zsh_history | grep brew
-    cat = subprocess.Popen(('cat', str(Path('~/.zsh_history').expanduser())), stdout=subprocess.PIPE)
-    output = subprocess.check_output(('grep', 'brew'), stdin=cat.stdout)
-    cat.wait()
+    files = [Path(x).expanduser() for x in data['files']]
+    folders = [Path(x).expanduser() for x in data['folders']]
 
-    with open(destination_folder / 'zsh_history_brew.txt', 'wb') as f:
-        f.write(output)
+    def _copy_file(file):
+        # copy_file keeps the modification time through copystat, so large unchanged files are recognized by the next incremental backup
+        copy_file(file, destination_folder)
 
-def generate_conda_list(destination_folder):
-    envs_save_folder = destination_folder / 'conda_envs'
-    envs_save_folder.mkdir(exist_ok=True)
+    def _copy_folder(folder):
+        shutil.copytree(folder, destination_folder / folder.name, copy_function=copy_file)
 
-    if platform.node() == 'Prix.local':
-        conda_exe = '/Users/longyuxi/miniforge3/condabin/mamba'
-    elif platform.node() == '1080-ubuntu':
-        conda_exe = '/home/longyuxi/mambaforge/condabin/mamba'
+    # Copying is I/O bound, so spread it over threads unless there is little to copy
+    if len(files) + len(folders) > 4:
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            futures = [executor.submit(_copy_file, file) for file in files]
+            futures += [executor.submit(_copy_folder, folder) for folder in folders]
+            for future in futures:
+                future.result()  # Re-raises any exception from the worker
     else:
-        raise NotImplementedError
-
-    envs_json = subprocess.check_output([conda_exe, 'env', 'list', '--json'])
-    envs = json.loads(envs_json)
-
-    for env in envs['envs']:
-        env_name = Path(env).name
-        print(env_name)
-        env_export = subprocess.check_output([conda_exe, 'env', 'export', '-n', env_name, '--from-history'])
-
-        env_shortname = env_name.split('/')[-1]
-        with open(envs_save_folder / f'{env_shortname}.yaml', 'wb') as f:
-            f.write(env_export)
+        for file in files:
+            _copy_file(file)
+        for folder in folders:
+            _copy_folder(folder)
 
+def generate_brew_list(destination_folder):
+    # Equivalent of cat ~/.zsh_history | grep brew. Read as bytes since zsh history is not always valid UTF-8
+    history = Path('~/.zsh_history').expanduser().read_bytes()
+    output = b''.join(line + b'\n' for line in history.split(b'\n') if b'brew' in line)
+
+    (destination_folder / 'zsh_history_brew.txt').write_bytes(output)
+
+def list_conda_envs(conda_exe):
+    """Returns the prefixes of the conda environments, like `conda env list` but without starting conda. Base environment comes first."""
+    root = Path(conda_exe).parents[1]  # <root>/condabin/mamba
+    prefixes = [root]
+    if (root / 'envs').is_dir():
+        prefixes += sorted(p for p in (root / 'envs').iterdir() if (p / 'conda-meta').is_dir())
+
+    # Environments created outside of <root>/envs are registered here
+    environments_txt = Path('~/.conda/environments.txt').expanduser()
+    if environments_txt.exists():
+        for line in environments_txt.read_text().splitlines():
+            prefix = Path(line.strip())
+            if line.strip() and prefix not in prefixes and (prefix / 'conda-meta').is_dir():
+                prefixes.append(prefix)
+
+    return prefixes
+
+def export_env_from_history(prefix, name):
+    """Returns the equivalent of `conda env export --from-history` for the environment as YAML, built from the explicitly requested specs in its conda-meta/history.
+
+    Raises ValueError if the history cannot be parsed.
+    """
+    specs = {}  # package name -> spec, in the order they were first requested
+    channels = []
+
+    for line in (Path(prefix) / 'conda-meta' / 'history').read_text().splitlines():
+        # Installed packages, e.g. "+conda-forge/osx-arm64::numpy-1.26.4-py312h8442bc7_0"
+        if line.startswith('+') and '::' in line:
+            channel = line[1:].split('::')[0].rstrip('/')
+            channel = re.sub(r'/(noarch|(linux|osx|win)-\w+)$', '', channel)
+            channel = channel.removeprefix('https://conda.anaconda.org/')
+            if channel not in channels:
+                channels.append(channel)
+            continue
+
+        # Requested specs, e.g. "# update specs: ['python=3.12', 'numpy']"
+        match = re.match(r'#\s*(\w+)\s*specs:\s*(.+)?\s*$', line)
+        if not match:
+            continue
+        action, specs_string = match.groups()
+        if not specs_string or not specs_string.startswith('['):
+            # Histories written by conda < 4.4 use a different format
+            raise ValueError(f'Cannot parse specs line in history of {prefix}: {line}')
+        try:
+            line_specs = ast.literal_eval(specs_string)
+        except (SyntaxError, ValueError, TypeError, RecursionError) as e:
+            raise ValueError(f'Cannot parse specs line in history of {prefix}: {line}') from e
+        if not isinstance(line_specs, list) or not all(isinstance(spec, str) for spec in line_specs):
+            raise ValueError(f'Cannot parse specs line in history of {prefix}: {line}')
+
+        for spec in line_specs:
+            name_match = re.match(r'[^\s=<>!~\[]+', spec.split('::')[-1])
+            if name_match is None:
+                raise ValueError(f'Cannot parse spec {spec!r} in history of {prefix}.')
+            spec_name = name_match.group(0)
+            if action in ('remove', 'uninstall'):
+                specs.pop(spec_name, None)
+            else:
+                # install, create, update and neutered specs all replace the previous spec
+                specs[spec_name] = spec
+
+    if not specs:
+        raise ValueError(f'No requested specs in history of {prefix}.')
+
+    return yaml.safe_dump({
+        'name': name,
+        'channels': channels,
+        'dependencies': list(specs.values()),
+        'prefix': str(prefix),
+    }, sort_keys=False).encode()
+
+def generate_conda_list(destination_folder, conda_exe):
+    envs_save_folder = destination_folder / 'conda_envs'
+    envs_save_folder.mkdir(exist_ok=True)
 
-def upload(source_folder, destination_folder, temporary_folder=Path(__file__).parent / 'temp', compress=False, use_absolute_paths_in_archive=False, folder_size_threshold_gb=1, number_to_keep=10):
-    uploadutils.make_archives(
-        source_folder,
-        folder_size_threshold_gb=folder_size_threshold_gb,
-        temporary_folder=temporary_folder,
-        compress=compress,
-        use_absolute_paths_in_archive=use_absolute_paths_in_archive)
-    uploadutils.update_archives(temporary_folder, destination_folder, number_to_keep)
+    prefixes = list_conda_envs(conda_exe)
+
+    def _export_env(prefix):
+        print(prefix.name)
+        with open(envs_save_folder / f'{prefix.name}.yaml', 'wb') as f:
+            try:
+                f.write(export_env_from_history(prefix, 'base' if prefix == prefixes[0] else prefix.name))
+            except (OSError, ValueError) as e:
+                # Fall back to mamba, which is much slower to start. Its output goes straight to the file.
+                print(f'{e} Exporting {prefix.name} with {conda_exe}.')
+                subprocess.run([conda_exe, 'env', 'export', '-p', str(prefix), '--from-history'], stdout=f, check=True)
+
+    # Fallback exports are independent, slow mamba processes, so run them concurrently
+    with ThreadPoolExecutor(max_workers=min(8, len(prefixes))) as executor:
+        list(executor.map(_export_env, prefixes))  # list() re-raises any exception from the workers
+
+
+def upload(source_folder, destination_folder, temporary_folder=Path(__file__).parent / 'temp', compress=False, compressor='pigz', use_absolute_paths_in_archive=False, folder_size_threshold_gb=1, number_to_keep=10):
+    archives = uploadutils.list_archives(destination_folder)
+    previous_snapshot_folder = destination_folder + f'{archives[-1]}/' if archives else None
+    snapshot_folder = uploadutils.snapshot_destination(destination_folder)
+    try:
+        uploadutils.make_archives(
+            source_folder,
+            folder_size_threshold_gb=folder_size_threshold_gb,
+            temporary_folder=temporary_folder,
+            destination=snapshot_folder,
+            compress=compress,
+            compressor=compressor,
+            use_absolute_paths_in_archive=use_absolute_paths_in_archive,
+            previous_destination=previous_snapshot_folder)
+        # Only the lists of folders in each tar file and the manifest are left in the temporary folder
+        uploadutils.upload_archives(temporary_folder, snapshot_folder)
+    except BaseException:
+        # A partial backup would count towards `number_to_keep` and be used as the previous backup next time
+        uploadutils.purge_archive(snapshot_folder)
+        raise
+    # Pruned last, as unchanged tar files are copied from the previous backup
+    uploadutils.prune_archives(destination_folder, number_to_keep)
     shutil.rmtree(temporary_folder)
 
-if __name__ == '__main__':
-    if platform.node() == 'Prix.local':
-        TEMPORARY_FOLDER = Path('/Users/longyuxi/Downloads/config-backup-temporary-folder')
-        # Delete if exists
-        if TEMPORARY_FOLDER.exists():
-            shutil.rmtree(TEMPORARY_FOLDER, ignore_errors=True)
-        TEMPORARY_FOLDER.mkdir(exist_ok=True)
-
-        INCLUDE_YAML = Path(__file__).parent / Path('mac-include.yaml')
-
-        copy_files_specified_by_yaml(INCLUDE_YAML, TEMPORARY_FOLDER)
-        generate_brew_list(TEMPORARY_FOLDER)
-        generate_conda_list(TEMPORARY_FOLDER)
-
-        DESTINATION_FOLDER =  'onedrive:backup/mac/configs/'
-
-        upload(TEMPORARY_FOLDER, DESTINATION_FOLDER)
+@functools.cache
+def load_hosts():
+    """Returns the per-machine configuration in hosts.yaml, keyed on platform.node()."""
+    return load_yaml_cached(Path(__file__).parent / 'hosts.yaml')
 
-    elif platform.node() == '1080-ubuntu':
-        TEMPORARY_FOLDER = Path('/home/longyuxi/Downloads/config-backup-temporary-folder')
-        shutil.rmtree(TEMPORARY_FOLDER, ignore_errors=True)
-        TEMPORARY_FOLDER.mkdir(exist_ok=True)
+def run(config):
+    """Runs the whole backup for one machine configuration from hosts.yaml."""
+    temporary_folder = Path(config['temporary_folder'])
+    # Delete if exists
+    shutil.rmtree(temporary_folder, ignore_errors=True)
+    temporary_folder.mkdir(exist_ok=True)
 
-        INCLUDE_YAML = Path(__file__).parent / Path('ubuntu-include.yaml')
+    copy_files_specified_by_yaml(Path(__file__).parent / config['include_yaml'], temporary_folder)
+    generate_brew_list(temporary_folder)
+    generate_conda_list(temporary_folder, config['conda_exe'])
 
-        copy_files_specified_by_yaml(INCLUDE_YAML, TEMPORARY_FOLDER)
-        generate_brew_list(TEMPORARY_FOLDER)
-        generate_conda_list(TEMPORARY_FOLDER)
+    upload(temporary_folder, config['destination_folder'])
 
-        DESTINATION_FOLDER =  'onedrive:backup/ubuntu/configs/'
-
-        upload(TEMPORARY_FOLDER, DESTINATION_FOLDER)
-
-
-    else:
+if __name__ == '__main__':
+    hosts = load_hosts()
+    if platform.node() not in hosts:
         print(platform.node(), 'is not implemented')
         raise NotImplementedError
+
+    run(hosts[platform.node()])
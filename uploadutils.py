@@ -1,109 +1,265 @@
 from pathlib import Path
 import subprocess
-import platform
+import os
+import stat
+import functools
+import hashlib
+import json
+import gzip
+import tarfile
 import shutil
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
 
-def du(path):
-    """Returns the size of the folder in bytes. Behavior of du command could different on different platforms.
+# Files up to this size are fingerprinted by their content rather than their modification time.
+# Generated files (e.g. conda_envs/*.yaml) are rewritten with a new modification time on every run even when nothing changed.
+CONTENT_FINGERPRINT_MAX_BYTES = 1024 ** 2
+
+@functools.lru_cache(maxsize=None)
+def scan(path):
+    """Returns `(size, fingerprint)` of the folder (or file), where size is the total size of the files in bytes and fingerprint changes when anything in it is added, removed or modified. Small files are compared by content, others by size and modification time. Symlinks are not followed.
     """
-    if platform.system() == 'Darwin':
-        return int(subprocess.check_output(['du','-sk', path]).split()[0].decode('utf-8')) * 1024
-    elif platform.system() == 'Linux':
-        return int(subprocess.check_output(['du','-sb', path]).split()[0].decode('utf-8'))
-    else:
-        raise NotImplementedError
+    path = str(path)
+    total = 0
+    descriptions = []
+
+    def _describe(entry_path, entry_stat):
+        relative_path = os.path.relpath(entry_path, path)
+        if stat.S_ISLNK(entry_stat.st_mode):
+            return (relative_path, 'link', os.readlink(entry_path))
+        if stat.S_ISDIR(entry_stat.st_mode):
+            return (relative_path, 'dir', entry_stat.st_mode)
+        if stat.S_ISREG(entry_stat.st_mode) and entry_stat.st_size <= CONTENT_FINGERPRINT_MAX_BYTES:
+            with open(entry_path, 'rb') as f:
+                return (relative_path, 'file', entry_stat.st_mode, hashlib.blake2b(f.read(), digest_size=16).hexdigest())
+        return (relative_path, 'file', entry_stat.st_mode, entry_stat.st_size, entry_stat.st_mtime_ns)
+
+    path_stat = os.lstat(path)
+    descriptions.append(_describe(path, path_stat))
+    if stat.S_ISREG(path_stat.st_mode):
+        total += path_stat.st_size
+
+    stack = [path] if stat.S_ISDIR(path_stat.st_mode) else []
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                entry_stat = entry.stat(follow_symlinks=False)
+                descriptions.append(_describe(entry.path, entry_stat))
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    total += entry_stat.st_size
+
+    # Relative paths are unique, so sorting never compares the rest of the tuples
+    fingerprint = hashlib.blake2b(json.dumps(sorted(descriptions)).encode(), digest_size=16).hexdigest()
+    return total, fingerprint
+
+# Compression programs the tar stream is piped through, with the extension of the resulting archive.
+# None means compressing in-process with gzip at level 1, which is ~3x cheaper than the default level for ~10% larger archives.
+COMPRESSORS = {
+    'pigz': ('pigz', '.tar.gz'),
+    'zstd': ('zstd -T0 -3', '.tar.zst'),
+    'gzip': (None, '.tar.gz'),
+}
+
+def resolve_compressor(compressor):
+    """Returns `(program, extension)` for the compressor, falling back to gzip if the requested program is not installed."""
+    if compressor not in COMPRESSORS:
+        raise ValueError(f'Unknown compressor {compressor}. Choose from {", ".join(COMPRESSORS)}.')
+
+    if COMPRESSORS[compressor][0] is not None and shutil.which(compressor) is None:
+        print(f'{compressor} not found. Falling back to gzip.')
+        compressor = 'gzip'
+
+    return COMPRESSORS[compressor]
 
 def make_archives(
         source: str | Path,
         folder_size_threshold_gb: float,
         temporary_folder: str | Path,
+        destination: str,
         use_absolute_paths_in_archive: bool = False,
         compress: bool = True,
+        compressor: str = 'pigz',
+        max_workers: int | None = None,
+        previous_destination: str | None = None,
 ):
     """Main function to run the backup process.
 
     Args:
         source (str | Path): Source folder to be backed up. Backs up "source/*" to "destination/*".
         folder_size_threshold_gb (float): Threshold for the size of the folder to be backed up. Folders are incrementally added to the tar file until the size exceeds this threshold.
-        temporary_folder (str | Path): Temporary folder to store the tar files before uploading to the destination. Needs not to be a subdirectory of source.
+        temporary_folder (str | Path): Temporary folder to store the list of folders in each tar file before uploading to the destination. Needs not to be a subdirectory of source.
+        destination (str): rclone destination folder (ending with a slash). Tar files are streamed to it with `rclone rcat` without being written to disk.
         use_absolute_paths_in_archive (bool, optional): If True, uses absolute paths in the tar file. Defaults to False.
-        compress (bool, optional): If True, compresses the tar file using gzip. Defaults to True.
+        compress (bool, optional): If True, compresses the tar file. Defaults to True.
+        compressor (str, optional): Program used to compress the tar file when `compress` is True. One of 'pigz', 'zstd' and 'gzip'. pigz and zstd use all cores. gzip runs in-process at compression level 1. Falls back to gzip if the program is not installed. Defaults to 'pigz'.
+        max_workers (int | None, optional): Number of tar files created and uploaded concurrently. pigz and zstd already use all cores for each tar file, so only a few are needed to overlap reading, compressing and uploading. Defaults to 2.
+        previous_destination (str | None, optional): rclone folder of the previous backup. Tar files whose folders have not changed since then (same fingerprints from `scan`, as recorded in its manifest.json) are copied from there instead of being recreated. Defaults to None.
     """
 
+    # Sizes and fingerprints cached by an earlier call may be out of date
+    scan.cache_clear()
+
     source = Path(source)
     folder_size_threshold_bytes = folder_size_threshold_gb * (1024 ** 3)
     temporary_folder = Path(temporary_folder)
     temporary_folder.mkdir(parents=True, exist_ok=True)
 
+    if not destination.endswith('/'):
+        raise Exception('Destination folder must end with a slash.')
+    if previous_destination is not None and not previous_destination.endswith('/'):
+        raise Exception('Previous destination folder must end with a slash.')
+
     # Check if temporary folder is a subdirectory of source
     if source in temporary_folder.parents:
         raise ValueError('Temporary folder cannot be a subdirectory of the source folder.')
 
-    # Check if temporary folder only contains what was supposedly previous backup files (i.e. *.txt, *.tar, and *.tar.gz)
+    if compress:
+        compress_program, archive_extension = resolve_compressor(compressor)
+    else:
+        archive_extension = '.tar'
+
+    # Remove what was supposedly previous backup files (i.e. *.txt, *.tar, *.tar.gz, *.tar.zst and manifest.json) from the temporary folder.
+    # Stops at anything else, which is left in place.
     for file in temporary_folder.iterdir():
-        if file.is_file():
-            if file.suffix in ['.txt', '.tar', '.gz']:
-                continue
-            if file.name == '.DS_Store':
-                continue
+        if file.is_file() and (file.suffix in ['.txt', '.tar', '.gz', '.zst'] or file.name in ['manifest.json', '.DS_Store']):
+            file.unlink()
+            continue
 
         raise ValueError(f'{str(file)} might not be a previous backup file. Exiting.')
 
-    # Then remove all the files in the temporary folder
-    shutil.rmtree(temporary_folder)
-    temporary_folder.mkdir(parents=True, exist_ok=True)
-
-    def _create_archive(folder_index, folder_size, folder_directories):
-        # Create a tar file for the current folder
-        if compress:
-            tar_file = temporary_folder / f'{folder_index}.tar.gz'
+    # Fingerprints of the tar files in the previous backup
+    previous_manifest = {}
+    if previous_destination is not None:
+        result = subprocess.run(['rclone', 'cat', previous_destination + 'manifest.json'], stdout=subprocess.PIPE)
+        if result.returncode == 0 and result.stdout:
+            previous_manifest = json.loads(result.stdout)
         else:
-            tar_file = temporary_folder / f'{folder_index}.tar'
+            print(f'No manifest found in {previous_destination}. Creating all tar files.')
 
-        if compress:
-            if use_absolute_paths_in_archive:
-                subprocess.check_output(['tar', '-czf', tar_file, *folder_directories])
-            else:
-                subprocess.check_output(['tar', '-czf', tar_file, '-C', str(source), *folder_directories])
-        else:
-            if use_absolute_paths_in_archive:
-                subprocess.check_output(['tar', '-cf', tar_file, *folder_directories])
-            else:
-                subprocess.check_output(['tar', '-cf', tar_file, '-C', str(source), *folder_directories])
+    def _create_archive(folder_index, folder_size, folder_directories, fingerprint):
+        archive_name = f'{folder_index}{archive_extension}'
 
         # Write list of folders in this tar file to a text file
-        with open(tar_file.with_suffix('.txt'), 'w') as f:
+        with open(temporary_folder / Path(archive_name).with_suffix('.txt'), 'w') as f:
             f.write('\n'.join(folder_directories))
 
-        print(f'Created tar file {tar_file}. Content size: {folder_size / (1024 ** 3)} GB. Output size: {tar_file.stat().st_size / (1024 ** 3)} GB.')
+        # Reuse the tar file from the previous backup if none of its folders changed
+        if previous_manifest.get(archive_name) == fingerprint:
+            # Server-side copy when both folders are on the same remote
+            subprocess.check_output(['rclone', 'copyto', previous_destination + archive_name, destination + archive_name])
+            print(f'Copied unchanged tar file {previous_destination + archive_name} to {destination + archive_name}.')
+            return
+
+        # Stream a tar file for the current folder straight to the destination
+        rclone_proc = subprocess.Popen(['rclone', 'rcat', destination + archive_name], stdin=subprocess.PIPE)
+        processes = [rclone_proc]
+        if compress and compress_program is not None:
+            compress_proc = subprocess.Popen(compress_program.split(), stdin=subprocess.PIPE, stdout=rclone_proc.stdin)
+            # Only the compressor writes to rclone now, so that rclone sees the end of the stream when the compressor exits
+            rclone_proc.stdin.close()
+            processes.insert(0, compress_proc)
+            sink = compress_proc.stdin
+        elif compress:
+            sink = gzip.GzipFile(fileobj=rclone_proc.stdin, mode='wb', compresslevel=1)
+        else:
+            sink = rclone_proc.stdin
+
+        broken_pipe = None
+        try:
+            with tarfile.open(fileobj=sink, mode='w|') as tf:
+                for folder_directory in folder_directories:
+                    # Leading slashes of absolute paths are stripped from the names in the archive, as tar does
+                    tf.add(folder_directory if use_absolute_paths_in_archive else source / folder_directory, arcname=folder_directory)
+        except BrokenPipeError as e:
+            # The compressor or rclone exited early. Its exit status is reported below.
+            broken_pipe = e
+        finally:
+            # tarfile and GzipFile leave the file objects they were given open
+            for pipe in [sink, rclone_proc.stdin]:
+                try:
+                    pipe.close()
+                except BrokenPipeError as e:
+                    broken_pipe = broken_pipe or e
+            for process in processes:
+                process.wait()
 
+        # rclone first, as the compressor dies with SIGPIPE when rclone exits early
+        for process in reversed(processes):
+            if process.returncode != 0:
+                raise subprocess.CalledProcessError(process.returncode, process.args)
+        if broken_pipe is not None:
+            raise broken_pipe
 
-    # Iteratively add folders to the tar file
-    current_folder_index = 0
+        print(f'Uploaded tar file {destination + archive_name}. Content size: {folder_size / (1024 ** 3)} GB.')
+
+
+    # Iteratively add folders to the tar file. Sorted so that unchanged folders end up in the same tar file as last time.
+    chunks = []  # (folder_size, folder_directories, folder_fingerprints) of each tar file
     current_folder_size = 0
     current_folder_directories = []
+    current_folder_fingerprints = []
 
-    for folder in source.iterdir():
+    for folder in sorted(source.iterdir()):
         if use_absolute_paths_in_archive:
             folder_name = folder
         else:
             folder_name = folder.name
 
-        current_folder_size += du(folder)
+        folder_size, folder_fingerprint = scan(folder)
+        current_folder_size += folder_size
         current_folder_directories.append(str(folder_name))
+        current_folder_fingerprints.append((str(folder_name), folder_fingerprint))
 
         if current_folder_size > folder_size_threshold_bytes:
-            _create_archive(current_folder_index, current_folder_size, current_folder_directories)
-
-            # Increment the index
-            current_folder_index += 1
+            chunks.append((current_folder_size, current_folder_directories, current_folder_fingerprints))
             current_folder_size = 0
             current_folder_directories = []
+            current_folder_fingerprints = []
 
-    # Create the last tar file
+    # The last tar file
     if current_folder_directories:
-        _create_archive(current_folder_index, current_folder_size, current_folder_directories)
+        chunks.append((current_folder_size, current_folder_directories, current_folder_fingerprints))
+
+    manifest = {
+        f'{folder_index}{archive_extension}': hashlib.blake2b(json.dumps(folder_fingerprints).encode(), digest_size=16).hexdigest()
+        for folder_index, (_, _, folder_fingerprints) in enumerate(chunks)
+    }
+
+    # Each tar file covers disjoint folders, so they can be created concurrently.
+    # tarfile runs in these threads, but it mostly waits on file reads and pipe writes, which release the GIL, as does zlib with in-process gzip.
+    # pigz, zstd and rclone run in child processes.
+    stop = threading.Event()
+
+    def _create_archive_unless_stopped(*args):
+        # A worker picks up the next tar file as soon as one fails, before the pending ones can be cancelled below
+        if stop.is_set():
+            return
+        try:
+            _create_archive(*args)
+        except BaseException:
+            stop.set()
+            raise
+
+    with ThreadPoolExecutor(max_workers=max_workers or 2) as executor:
+        futures = [executor.submit(_create_archive_unless_stopped, folder_index, folder_size, folder_directories, manifest[f'{folder_index}{archive_extension}'])
+                   for folder_index, (folder_size, folder_directories, _) in enumerate(chunks)]
+        try:
+            wait(futures, return_when=FIRST_EXCEPTION)
+        finally:
+            # Stop at the first failed tar file (or Ctrl-C) instead of starting the rest, as upload() deletes the whole backup then
+            stop.set()
+            for future in futures:
+                future.cancel()
+        for future in futures:
+            if not future.cancelled():
+                future.result()  # Re-raises any exception from the worker
+
+    # Uploaded together with the lists of folders, so that the next backup can tell which tar files are unchanged
+    with open(temporary_folder / 'manifest.json', 'w') as f:
+        json.dump(manifest, f, indent=2)
 
 
 # Print output as executing https://stackoverflow.com/a/4417735/10538006
@@ -111,13 +267,34 @@ def execute(cmd):
     with subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=1, universal_newlines=True) as p:
         for line in p.stdout:
             print(line, end='')
+    if p.returncode != 0:
+        raise subprocess.CalledProcessError(p.returncode, cmd)
 
 def upload_archives(temporary_folder, destination):
     """Uses rclone to upload all the files in the temporary folder to the destination."""
+    # Only the small lists of folders and manifest.json go through here (tar files are streamed with rclone rcat), so rclone's transfer tuning flags would not apply
     execute(['rclone', 'copy', str(temporary_folder), destination, '--progress'])
 
-def update_archives(temporary_folder, base_destination_folder, number_to_keep):
-    """Deletes the oldest archives in the base destination folder to keep only the latest `number_to_keep` archives."""
+def snapshot_destination(base_destination_folder):
+    """Returns a new timestamped snapshot folder inside the base destination folder."""
+    if not base_destination_folder.endswith('/'):
+        raise Exception('Base destination folder must end with a slash.')
+
+    return base_destination_folder + str(int(time.time())) + '/'
+
+def purge_archive(destination):
+    """Deletes an archive folder left incomplete by a failed backup, if the backup got as far as creating it. Errors are only printed, as this is used while handling another error."""
+    result = subprocess.run(['rclone', 'purge', destination], stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode == 0:
+        print('Deleted incomplete destination folder:', destination)
+    elif result.returncode == 3 or 'directory not found' in result.stderr:
+        pass  # Backup failed before uploading anything, so there is nothing to delete
+    else:
+        print(result.stderr, end='')
+        print(f'Could not delete incomplete destination folder {destination}. Delete it manually.')
+
+def list_archives(base_destination_folder):
+    """Returns the timestamps of the archives in the base destination folder, oldest first."""
     if not base_destination_folder.endswith('/'):
         raise Exception('Base destination folder must end with a slash.')
 
@@ -130,15 +307,21 @@ def update_archives(temporary_folder, base_destination_folder, number_to_keep):
     except ValueError:
         raise Exception('Folders in the destination base must be integers.')
 
-    if len(folders) > number_to_keep - 1:
-        folders.sort()
-        folders_to_delete = folders[:-(number_to_keep - 1)]
-        print('Deleting destination folders:', *folders_to_delete)
-        for folder in folders_to_delete:
-            print('rclone', 'purge', base_destination_folder + str(folder) + '/')
-            execute(['rclone', 'purge', base_destination_folder + str(folder) + '/'])
+    return sorted(folders)
+
+def prune_archives(base_destination_folder, number_to_keep):
+    """Deletes the oldest archives in the base destination folder to keep only the latest `number_to_keep` archives."""
+    folders = list_archives(base_destination_folder)
 
-    upload_archives(temporary_folder, base_destination_folder + str(int(time.time())) + '/')
+    if len(folders) > number_to_keep:
+        folders_to_delete = folders[:-number_to_keep]
+        print('Deleting destination folders:', *folders_to_delete)
+        # One rclone invocation for all the folders instead of one purge each
+        cmd = ['rclone', 'delete', base_destination_folder,
+               '--include', '/{' + ','.join(str(folder) for folder in folders_to_delete) + '}/**',
+               '--rmdirs']
+        print(*cmd)
+        execute(cmd)
 
 # if __name__ == '__main__':
 #     # Test parameters -- just back up a small folder
@@ -147,7 +330,8 @@ def update_archives(temporary_folder, base_destination_folder, number_to_keep):
 #     temporary_folder = '/Users/longyuxi/Downloads/backuptemp/'
 #     base_destination_folder = 'onedrive:backup/mac/test/'
 
-#     make_archives(source, folder_size_threshold_gb, temporary_folder)
-#     time.sleep(5)
-#     update_archives(temporary_folder, base_destination_folder, 3)
+#     destination = snapshot_destination(base_destination_folder)
+#     make_archives(source, folder_size_threshold_gb, temporary_folder, destination)
+#     upload_archives(temporary_folder, destination)
+#     prune_archives(base_destination_folder, 3)
 